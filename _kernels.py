@@ -0,0 +1,186 @@
+# python
+"""Núcleos numéricos da geração de combinações, compilados com numba quando disponível.
+
+O numba é opcional: sem ele, `DISPONIVEL` fica False e `preferencias.py` usa as versões em
+Python/NumPy. As funções abaixo continuam importáveis (e corretas) sem o numba, apenas lentas.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba é opcional
+    njit = None
+
+DISPONIVEL = njit is not None
+
+
+def _compilar(func):
+    """Aplica `njit(cache=True)` se o numba estiver instalado; caso contrário, devolve a função original."""
+    return njit(cache=True)(func) if DISPONIVEL else func
+
+
+@_compilar
+def _popcount(x):
+    """Quantidade de bits ligados de um inteiro não negativo pequeno."""
+    total = 0
+    while x:
+        x &= x - 1
+        total += 1
+    return total
+
+
+@_compilar
+def buscar_combinacoes(conflitos, candidatos, dias_mask, turnos_mask, dias0, turnos0, n_obrig,
+                       aceita_tamanho, min_extras, max_extras, alvo_qtd_dias, por_turnos, por_dias,
+                       turnos_permitidos, limite):
+    """Busca em profundidade de `gerar_combinacoes` com pilha explícita.
+
+    - `conflitos`: matriz booleana (n, n) de conflitos entre as linhas;
+    - `candidatos`: booleano (n,) com as linhas que podem entrar além das obrigatórias;
+    - `aceita_tamanho[t]`: True se combinações de tamanho total `t` são pedidas;
+    - `alvo_qtd_dias`: 0 quando não há alvo de dias;
+    - `por_turnos` / `por_dias`: booleanos (máscara, n) com as linhas que ainda cabem dada a máscara
+      de turnos / de dias acumulada (ver `_candidatos_compativeis`);
+    - `turnos_permitidos`: tabela indexada pela máscara de turnos.
+
+    Visita no máximo `limite` nós, na mesma ordem da versão recursiva, e retorna
+    `(itens, limites, visitados)`: as posições escolhidas de cada combinação aceita, concatenadas em
+    pré-ordem, os limites de cada uma em `itens` e a quantidade de nós visitados.
+    """
+    n = len(candidatos)
+    profundidade_max = max(max_extras, 0) + 1
+
+    # Estado por nível da pilha: candidatos ainda não tentados, a partir de `proximo`
+    cand = np.zeros((profundidade_max, n), dtype=np.bool_)
+    restantes = np.zeros(profundidade_max, dtype=np.int64)
+    proximo = np.zeros(profundidade_max, dtype=np.int64)
+    dias = np.zeros(profundidade_max, dtype=np.int64)
+    turnos = np.zeros(profundidade_max, dtype=np.int64)
+    no_atual = np.zeros(profundidade_max, dtype=np.int64)
+
+    # Árvore dos nós visitados (pai e linha escolhida), para reconstruir as combinações aceitas
+    pai = np.empty(limite, dtype=np.int64)
+    item = np.empty(limite, dtype=np.int64)
+    nivel = np.empty(limite, dtype=np.int64)
+    aceitos = np.empty(limite, dtype=np.int64)
+    n_aceitos = 0
+    visitados = 0
+
+    for k in range(n):
+        cand[0, k] = candidatos[k]
+        if candidatos[k]:
+            restantes[0] += 1
+    dias[0] = dias0
+    turnos[0] = turnos0
+
+    d = 0
+    novo_no = True
+    pai_atual = -1
+    item_atual = -1
+    while d >= 0:
+        if novo_no:
+            novo_no = False
+            if visitados >= limite:
+                break
+            no = visitados
+            visitados += 1
+            pai[no] = pai_atual
+            item[no] = item_atual
+            nivel[no] = d
+            no_atual[d] = no
+            if (aceita_tamanho[n_obrig + d] and turnos_permitidos[turnos[d]]
+                    and (alvo_qtd_dias == 0 or _popcount(dias[d]) == alvo_qtd_dias)):
+                aceitos[n_aceitos] = no
+                n_aceitos += 1
+            if d >= max_extras:
+                d -= 1
+                continue
+
+        # Próximo candidato do nível d (ou volta um nível)
+        if restantes[d] == 0 or d + restantes[d] < min_extras:
+            d -= 1
+            continue
+        j = proximo[d]
+        while not cand[d, j]:
+            j += 1
+        proximo[d] = j + 1
+        restantes[d] -= 1
+
+        novos_turnos = turnos[d] | turnos_mask[j]
+        novos_dias = dias[d] | dias_mask[j]
+        if visitados >= limite:
+            break
+
+        # Desce: candidatos do filho = restantes do pai (posições > j) que ainda cabem nos turnos e
+        # dias do filho (testes baratos primeiro) e não conflitam com j
+        total = 0
+        for k in range(j + 1, n):
+            livre = cand[d, k] and por_turnos[novos_turnos, k] and por_dias[novos_dias, k] and not conflitos[j, k]
+            cand[d + 1, k] = livre
+            if livre:
+                total += 1
+        restantes[d + 1] = total
+        proximo[d + 1] = j + 1
+        dias[d + 1] = novos_dias
+        turnos[d + 1] = novos_turnos
+        pai_atual = no_atual[d]
+        item_atual = j
+        d += 1
+        novo_no = True
+
+    # Reconstrói as combinações aceitas subindo pelos pais
+    limites = np.zeros(n_aceitos + 1, dtype=np.int64)
+    for a in range(n_aceitos):
+        limites[a + 1] = limites[a] + nivel[aceitos[a]]
+    itens = np.empty(limites[n_aceitos], dtype=np.int64)
+    for a in range(n_aceitos):
+        no = aceitos[a]
+        pos = limites[a + 1] - 1
+        while nivel[no] > 0:
+            itens[pos] = item[no]
+            pos -= 1
+            no = pai[no]
+    return itens, limites, visitados
+
+
+@_compilar
+def avaliar_combinacoes(posicoes, limites, dias_mask, turnos_mask, pref_mask, alvo_qtd_dias, grupo, turma):
+    """Dias totais e score de cada combinação (linhas `posicoes[limites[c]:limites[c + 1]]`).
+
+    Mesmas regras de `preferencias.avaliar_combinacoes`: +1 por disciplina em turno preferido, +2 se os
+    dias totais batem com `alvo_qtd_dias` (0 = sem alvo) e +1 por turma extra de um mesmo grupo
+    (CURSO, DISCIPLINA).
+    """
+    n_combos = len(limites) - 1
+    dias = np.zeros(n_combos, dtype=np.int64)
+    score = np.zeros(n_combos, dtype=np.int64)
+    for c in range(n_combos):
+        ini, fim = limites[c], limites[c + 1]
+        mask = 0
+        for a in range(ini, fim):
+            p = posicoes[a]
+            mask |= dias_mask[p]
+            if turnos_mask[p] & pref_mask:
+                score[c] += 1
+        dias[c] = _popcount(mask)
+        if alvo_qtd_dias != 0 and dias[c] == alvo_qtd_dias:
+            score[c] += 2
+
+        # Pares (grupo, turma) distintos menos grupos distintos, entre as linhas com ambos os códigos
+        for a in range(ini, fim):
+            ga, ta = grupo[posicoes[a]], turma[posicoes[a]]
+            if ga < 0 or ta < 0:
+                continue
+            par_novo = True
+            grupo_novo = True
+            for b in range(ini, a):
+                gb, tb = grupo[posicoes[b]], turma[posicoes[b]]
+                if gb < 0 or tb < 0:
+                    continue
+                if gb == ga:
+                    grupo_novo = False
+                    if tb == ta:
+                        par_novo = False
+            if par_novo and not grupo_novo:
+                score[c] += 1
+    return dias, score
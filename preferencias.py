@@ -1,10 +1,28 @@
 # python
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from functools import reduce
 from itertools import combinations
+import heapq
+from operator import or_
 import unicodedata
+import hashlib
 import io
+import re
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:  # pyarrow é opcional: sem ele, o CSV é lido pelo pandas
+    pa = pacsv = None
+
+import _kernels
+
+# Copy-on-Write: seleções e filtros compartilham os buffers do DataFrame base sem cópias defensivas
+# (já é o comportamento padrão a partir do pandas 3.0)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
 
 # --- CONFIGURAÇÕES E CONSTANTES ---
 
@@ -17,13 +35,40 @@ DIAS_SEMANA_MAP = {
     "SAB": "Sábado"
 }
 
+# Índice numérico de cada dia (0 = SEG ... 5 = SAB), usado nas representações em arrays
+DIA_IDX = {sigla: i for i, sigla in enumerate(DIAS_SEMANA_MAP)}
+DIAS_NOMES = np.array(list(DIAS_SEMANA_MAP.values()), dtype=object)
+
+# Minutos em um dia: cada dia ocupa um bloco de 1440 bits na máscara de ocupação semanal
+MINUTOS_DIA = 24 * 60
+
+# Faixas de início de cada turno, em minutos desde 00:00 (limites inclusivos)
 TURNOS = {
-    "Manhã": (datetime.strptime("07:00", "%H:%M").time(), datetime.strptime("12:00", "%H:%M").time()),
-    "Tarde": (datetime.strptime("12:01", "%H:%M").time(), datetime.strptime("18:00", "%H:%M").time()),
-    "Noite": (datetime.strptime("18:01", "%H:%M").time(), datetime.strptime("23:00", "%H:%M").time())
+    "Manhã": (7 * 60, 12 * 60),
+    "Tarde": (12 * 60 + 1, 18 * 60),
+    "Noite": (18 * 60 + 1, 23 * 60)
 }
 
-MAX_COMBINACOES = 100000  # limite de segurança para geração
+# Um bit por turno, para combinar os turnos de uma grade com OR
+TURNO_BITS = {"Manhã": 1, "Tarde": 2, "Noite": 4, "Indefinido": 8}
+
+# Conjuntos de turnos aceitos em uma grade (ver is_turno_set_permitido)
+TURNOS_PERMITIDOS_MASK = (TURNO_BITS["Manhã"] | TURNO_BITS["Tarde"], TURNO_BITS["Tarde"] | TURNO_BITS["Noite"])
+
+# Para cada máscara de turnos possível: ainda cabe em algum conjunto permitido? (poda da busca)
+TURNOS_VIAVEIS = tuple(
+    any(mask & ~permitido == 0 for permitido in TURNOS_PERMITIDOS_MASK)
+    for mask in range(1 << len(TURNO_BITS))
+)
+
+MAX_COMBINACOES = 100000  # limite de segurança para geração (nós visitados na busca)
+MAX_OPCOES_EXIBIDAS = 1000  # limite de opções listadas por cenário na Etapa 3 (as de maior score)
+
+# Um horário no formato "SEG - 08:00 às 10:00" (tolera "as" sem acento e espaços extras)
+_HORARIO_RE = re.compile(
+    r"(SEG|TER|QUA|QUI|SEX|SAB)\s*-\s*(\d{1,2}):(\d{2})\s*(?:às|as)\s*(\d{1,2}):(\d{2})",
+    re.IGNORECASE,
+)
 
 # --- ESTADO GLOBAL DO FLUXO E FIXAÇÃO ---
 
@@ -33,7 +78,11 @@ if "current_step" not in st.session_state:
 
 # Mantém compatibilidade com seleção atual
 if "selecionados_ids" not in st.session_state:
-    st.session_state["selecionados_ids"] = []
+    st.session_state["selecionados_ids"] = set()
+
+# Versão da seleção: incrementada a cada alteração de selecionados_ids (ver _marcar_selecao_alterada)
+if "_sel_version" not in st.session_state:
+    st.session_state["_sel_version"] = 0
 
 # Conjunto de ROW_IDs fixos (subconjunto de selecionados)
 if "fixos_ids" not in st.session_state:
@@ -51,77 +100,176 @@ if "mapa_grupos_fixas" not in st.session_state:
 if "singles_sao_obrigatorias" not in st.session_state:
     st.session_state["singles_sao_obrigatorias"] = False
 
+def _marcar_selecao_alterada():
+    """Registra que `selecionados_ids` mudou (fixos precisam ser revalidados)."""
+    st.session_state["_sel_version"] += 1
+
 def _ensure_fixed_subset_of_selected():
-    """Garante que fixos ⊆ selecionados."""
-    st.session_state["fixos_ids"] = set(map(str, st.session_state.get("fixos_ids", set()))) & set(map(str, st.session_state.get("selecionados_ids", [])))
+    """Garante que fixos ⊆ selecionados (só refaz a interseção se a seleção mudou desde a última vez)."""
+    if st.session_state.get("_fixos_version") == st.session_state["_sel_version"]:
+        return
+    st.session_state["fixos_ids"] &= st.session_state["selecionados_ids"]
+    st.session_state["_fixos_version"] = st.session_state["_sel_version"]
 
 def _go_to_step(step: int):
     st.session_state["current_step"] = int(step)
 
+def _valores_coluna(df: pd.DataFrame, col: str) -> list:
+    """Valores da coluna como lista (ou '' por linha se a coluna não existir), para montar rótulos sem iterar linhas."""
+    return df[col].tolist() if col in df.columns else [''] * len(df)
+
 def _style_bold_fixed(df_show: pd.DataFrame, fixed_ids: set):
-    """Retorna um Styler com linhas fixas em negrito."""
-    if "ROW_ID" not in df_show.columns:
+    """Retorna um Styler com linhas fixas (índice = ROW_ID) em negrito (ou o próprio DataFrame, se nenhuma linha for fixa)."""
+    fixas = df_show.index.isin(fixed_ids)
+    if not fixas.any():
         return df_show
-    df_show = df_show.copy()
-    df_show["ROW_ID"] = df_show["ROW_ID"].astype(str)
-    df_show = df_show.set_index("ROW_ID", drop=False)
-    def _bold_row(idx):
-        return ['font-weight: bold'] * len(df_show.columns) if idx in fixed_ids else [''] * len(df_show.columns)
+    # Um único DataFrame de CSS para a tabela toda, em vez de uma chamada por linha
+    estilos = pd.DataFrame(
+        np.repeat(np.where(fixas, 'font-weight: bold', '')[:, None], len(df_show.columns), axis=1),
+        index=df_show.index, columns=df_show.columns,
+    )
     try:
-        return df_show.style.apply(lambda s: _bold_row(s.name), axis=1)
+        return df_show.style.apply(lambda _: estilos, axis=None)
     except Exception:
         return df_show
 
 # --- FUNÇÕES AUXILIARES ---
 
+# Tabela de tradução dos acentos usuais do português (á→a, ç→c, ...), maiúsculas inclusas
+_LETRAS_ACENTUADAS = "áàâãäéèêëíìîïóòôõöúùûüçñ"
+_ACCENT_TABLE = str.maketrans({
+    ch: unicodedata.normalize("NFD", ch)[0]
+    for ch in _LETRAS_ACENTUADAS + _LETRAS_ACENTUADAS.upper()
+})
+
 def _normalize(s: str) -> str:
     """Remove acentos e converte para minúsculas para comparações insensíveis."""
     if not isinstance(s, str):
         return ""
-    s = unicodedata.normalize("NFD", s)
-    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    s = s.translate(_ACCENT_TABLE)
+    if not s.isascii():
+        # Caracteres fora da tabela: decomposição NFD completa
+        s = unicodedata.normalize("NFD", s)
+        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
     return s.lower().strip()
 
-@st.cache_data
-def parse_horarios(horario_str):
-    """Converte a string de horário do CSV em uma lista de dicionários estruturados."""
-    horarios_processados = []
-    if not isinstance(horario_str, str):
-        return []
+def _explodir_horarios(horarios: pd.Series) -> pd.DataFrame:
+    """Extrai os horários de toda a série de uma vez, em formato longo (uma linha por horário).
 
-    horario_str = horario_str.replace(" as ", " às ").replace(" as ", " às ")
-    partes = horario_str.split(',')
+    O índice repete o rótulo da linha de origem; colunas: 'dia' (0 = SEG ... 5 = SAB),
+    'inicio' e 'fim' (minutos desde 00:00).
+    """
+    partes = horarios.fillna('').astype(str).str.extractall(_HORARIO_RE)
+    if partes.empty:
+        return pd.DataFrame({
+            'dia': pd.Series(dtype='int16'),
+            'inicio': pd.Series(dtype='int16'),
+            'fim': pd.Series(dtype='int16'),
+        })
 
-    for parte in partes:
-        if 'às' not in parte:
-            continue
-        try:
-            dia_str, tempo_str = parte.split('-', 1)
-            dia_str = dia_str.strip().upper()
+    partes.columns = ['dia', 'h1', 'm1', 'h2', 'm2']
+    h1, m1, h2, m2 = (partes[c].astype('int16') for c in ['h1', 'm1', 'h2', 'm2'])
+    validos = (h1 < 24) & (h2 < 24) & (m1 < 60) & (m2 < 60)
 
-            if dia_str not in DIAS_SEMANA_MAP:
-                continue
+    longo = pd.DataFrame({
+        'dia': partes['dia'].str.upper().map(DIA_IDX).astype('int16'),
+        'inicio': h1 * 60 + m1,
+        'fim': h2 * 60 + m2,
+    })[validos]
+    return longo.droplevel('match')
 
-            inicio_str, fim_str = [t.strip() for t in tempo_str.split('às')]
 
-            horario = {
-                "dia": DIAS_SEMANA_MAP[dia_str],
-                "inicio": datetime.strptime(inicio_str, "%H:%M").time(),
-                "fim": datetime.strptime(fim_str, "%H:%M").time()
-            }
-            horarios_processados.append(horario)
-        except (ValueError, IndexError):
-            continue
+def get_turno(inicio: np.ndarray) -> np.ndarray:
+    """Bit de TURNO_BITS de cada horário a partir do início (minutos desde 00:00)."""
+    inicio = np.asarray(inicio)
+    condicoes = [(inicio >= ini) & (inicio <= fim) for ini, fim in TURNOS.values()]
+    return np.select(condicoes, [TURNO_BITS[t] for t in TURNOS], default=TURNO_BITS["Indefinido"]).astype(np.uint8)
+
+
+def _fmt_minutos(minutos) -> str:
+    """Formata minutos desde 00:00 como 'HH:MM'."""
+    return f"{int(minutos) // 60:02d}:{int(minutos) % 60:02d}"
+
+
+def _or_por_linha(bits: np.ndarray, pos: np.ndarray, n: int) -> np.ndarray:
+    """OR de `bits` agrupado pela posição de linha `pos` (não decrescente); linhas sem valores ficam 0."""
+    saida = np.zeros(n, dtype=np.uint8)
+    if len(bits):
+        inicios = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]])
+        saida[pos[inicios]] = np.bitwise_or.reduceat(bits, inicios)
+    return saida
 
-    return horarios_processados
 
+def _nomes_por_mask(nomes: list) -> list:
+    """Tabela máscara -> lista dos `nomes` cujos bits estão ligados (bit i = nomes[i])."""
+    return [[nome for i, nome in enumerate(nomes) if m >> i & 1] for m in range(1 << len(nomes))]
 
-def get_turno(horario):
-    """Determina o turno de um determinado horário."""
-    for nome_turno, (inicio_turno, fim_turno) in TURNOS.items():
-        if inicio_turno <= horario['inicio'] <= fim_turno:
-            return nome_turno
-    return "Indefinido"
+_DIAS_POR_MASK = _nomes_por_mask(list(DIAS_NOMES))
+_TURNOS_POR_MASK = _nomes_por_mask(list(TURNO_BITS))
+_DIA_BITS = {nome: 1 << i for i, nome in enumerate(DIAS_NOMES)}
+
+
+def _colunas_de_horario(horarios: pd.Series) -> pd.DataFrame:
+    """Constrói as colunas derivadas dos horários de cada linha (Struct-of-Arrays).
+
+    - 'horarios_arr': array int16 (n_horarios, 3) com [dia, inicio, fim] por horário;
+    - 'DIAS' / 'TURNOS': listas com os dias e turnos distintos da linha;
+    - 'DIAS_MASK': uint8 com um bit por dia da semana (bit 0 = SEG);
+    - 'TURNOS_MASK': uint8 com os bits de TURNO_BITS presentes na linha;
+    - 'OCUPACAO': inteiro com um bit por minuto ocupado na semana (conflito = AND não nulo).
+
+    Cada string de horário distinta é processada uma única vez (ofertas de cursos/turmas diferentes
+    repetem muito os mesmos horários); as linhas repetidas reaproveitam o resultado.
+    """
+    codigos, unicos = pd.factorize(horarios.fillna('').astype(str))
+    longo = _explodir_horarios(pd.Series(unicos, dtype=object))
+    n = len(unicos)
+    pos = longo.index.to_numpy()
+
+    # Linhas consecutivas no formato longo: basta fatiar pelos offsets de cada linha
+    valores = longo[['dia', 'inicio', 'fim']].to_numpy(dtype=np.int16)
+    cortes = np.cumsum(np.bincount(pos, minlength=n))[:-1]
+    arrays = np.empty(n, dtype=object)
+    for i, fatia in enumerate(np.split(valores, cortes)):
+        arrays[i] = fatia
+
+    # Bits de dia e turno por horário, reduzidos por linha; as listas de nomes saem das máscaras
+    dias_mask = _or_por_linha(np.left_shift(1, valores[:, 0]).astype(np.uint8), pos, n)
+    turnos_mask = _or_por_linha(get_turno(valores[:, 1]), pos, n)
+
+    # Máscara de ocupação: bits [dia*1440 + inicio, dia*1440 + fim) de cada horário.
+    # Inteiros Python têm precisão arbitrária, então a semana inteira cabe em um único valor.
+    # Deslocamentos e larguras saem do NumPy já como int nativos (tolist), sem boxing por elemento.
+    deslocamento = (valores[:, 0].astype(np.int64) * MINUTOS_DIA + valores[:, 1]).tolist()
+    largura = np.clip(valores[:, 2].astype(np.int64) - valores[:, 1], 0, None).tolist()
+    ocupacao = [0] * n
+    for p, desl, larg in zip(pos.tolist(), deslocamento, largura):
+        ocupacao[p] |= ((1 << larg) - 1) << desl
+
+    # De volta às linhas: cada uma recebe o resultado da sua string (as listas de nomes são próprias da linha)
+    dias_mask, turnos_mask = dias_mask[codigos], turnos_mask[codigos]
+    return pd.DataFrame({
+        'horarios_arr': arrays[codigos],
+        'DIAS': [list(_DIAS_POR_MASK[m]) for m in dias_mask.tolist()],
+        'TURNOS': [list(_TURNOS_POR_MASK[m]) for m in turnos_mask.tolist()],
+        'DIAS_MASK': dias_mask,
+        'TURNOS_MASK': turnos_mask,
+        'OCUPACAO': pd.Series([ocupacao[c] for c in codigos.tolist()], index=horarios.index, dtype=object),
+    }, index=horarios.index)
+
+
+def _colunas_de_grupo(df: pd.DataFrame) -> pd.DataFrame:
+    """Códigos inteiros usados no score: 'CURSO_DISC_ID' por (CURSO, DISCIPLINA) e 'TURMA_ID'.
+
+    Linhas com algum desses campos vazio recebem -1 (ficam fora da contagem, como no groupby).
+    """
+    if not {'CURSO', 'DISCIPLINA', 'TURMA'}.issubset(df.columns):
+        return pd.DataFrame({'CURSO_DISC_ID': -1, 'TURMA_ID': -1}, index=df.index, dtype='int32')
+    grupo = df.groupby(['CURSO', 'DISCIPLINA'], sort=False, dropna=True).ngroup()
+    return pd.DataFrame({
+        'CURSO_DISC_ID': grupo.fillna(-1).astype('int32'),
+        'TURMA_ID': pd.factorize(df['TURMA'])[0].astype('int32'),
+    }, index=df.index)
 
 
 def _build_horario_completo(df: pd.DataFrame) -> pd.DataFrame:
@@ -153,20 +301,92 @@ def _build_horario_completo(df: pd.DataFrame) -> pd.DataFrame:
         df['Dia 2'] = ''
 
     # Monta 'horario_completo'
-    df['horario_completo'] = (df['Dia 1'].fillna('') + ', ' + df['Dia 2'].fillna('')).str.strip(', ').fillna('')
+    df['horario_completo'] = (df['Dia 1'].fillna('') + ', ' + df['Dia 2'].fillna('')).str.strip(', ')
 
     return df
 
 
-@st.cache_data
+def _codigos_de_ordenacao(df: pd.DataFrame, colunas: list) -> np.ndarray:
+    """Códigos inteiros (colunas x linhas) que preservam a ordem de cada coluna; vazios vão para o fim.
+
+    Ordenar por esses códigos com `np.lexsort` equivale a `sort_values(colunas)` estável, sem
+    comparar strings a cada ordenação.
+    """
+    codigos = np.empty((len(colunas), len(df)), dtype=np.int64)
+    for i, coluna in enumerate(colunas):
+        cod, unicos = pd.factorize(df[coluna], sort=True)
+        codigos[i] = np.where(cod < 0, len(unicos), cod)
+    return codigos
+
+
+def _hash_arquivo(uploaded_file) -> str:
+    """Identifica o conteúdo de um arquivo enviado (sha1 dos bytes)."""
+    return hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+
+
+def _mk_row_ids(df: pd.DataFrame) -> pd.Series:
+    """Identificador estável (int64) de cada linha: hash de (CODIGO, TURMA, Dia 1, Dia 2).
+
+    O hash é truncado em 53 bits: cabe sem perda num número do frontend e evita
+    overflow quando o pandas tenta representar poucos ids como RangeIndex.
+    """
+    colunas = [c for c in ['CODIGO', 'TURMA', 'Dia 1', 'Dia 2'] if c in df.columns]
+    if not colunas:
+        return pd.Series(np.arange(len(df), dtype='int64'), index=df.index)
+    chave = df[colunas].fillna('').astype(str)
+    hashes = pd.util.hash_pandas_object(chave, index=False)
+    return (hashes & np.uint64((1 << 53) - 1)).astype('int64')
+
+
+def _ler_csv(dados: bytes) -> pd.DataFrame:
+    """Lê o CSV com o parser multithread do pyarrow, se disponível; senão, com o `pd.read_csv`."""
+    if pacsv is not None:
+        tabela = _ler_csv_pyarrow(dados)
+        if tabela is not None:
+            # Cabeçalhos vazios recebem o mesmo nome que o pandas daria ('Unnamed: i');
+            # nomes repetidos ficam para o pandas desambiguar ('X.1', ...)
+            nomes = [nome or f"Unnamed: {i}" for i, nome in enumerate(tabela.column_names)]
+            if len(set(nomes)) == len(nomes):
+                return tabela.rename_columns(nomes).to_pandas()
+    return pd.read_csv(io.StringIO(dados.decode("utf-8")))
+
+
+def _ler_csv_pyarrow(dados: bytes):
+    """Tabela do pyarrow com os tipos que o `pd.read_csv` daria, ou None se o pyarrow não conseguir ler.
+
+    O pyarrow infere datas e horas ('2024-01-01', '08:00') e dá tipo nulo a colunas vazias; o pandas
+    deixa as primeiras como texto e lê as vazias como float (NaN). Essas colunas são relidas com o tipo
+    do pandas.
+    """
+    def ler(tipos):
+        opcoes = pacsv.ConvertOptions(strings_can_be_null=True, timestamp_parsers=[], column_types=tipos)
+        try:
+            return pacsv.read_csv(io.BytesIO(dados), convert_options=opcoes)
+        except ValueError:
+            return None
+
+    tabela = ler({})
+    if tabela is None:
+        return None
+    tipos = {}
+    for campo in tabela.schema:
+        if pa.types.is_temporal(campo.type):
+            tipos[campo.name] = pa.string()
+        elif pa.types.is_null(campo.type):
+            tipos[campo.name] = pa.float64()
+    if tipos:
+        tabela = ler(tipos)
+    return tabela
+
+
+@st.cache_data(hash_funcs={"streamlit.runtime.uploaded_file_manager.UploadedFile": _hash_arquivo})
 def carregar_disciplinas(uploaded_file):
     """Carrega e processa as disciplinas do arquivo CSV."""
     if uploaded_file is None:
         return pd.DataFrame()
 
     try:
-        stringio = io.StringIO(uploaded_file.getvalue().decode("utf-8"))
-        df = pd.read_csv(stringio)
+        df = _ler_csv(uploaded_file.getvalue())
 
         # Garante colunas de horário e a coluna composta
         df = _build_horario_completo(df)
@@ -181,20 +401,19 @@ def carregar_disciplinas(uploaded_file):
             'COMPONENTE CURRICULAR': 'DISCIPLINA',
         }, inplace=True)
 
-        # Constrói objetos de horário
-        df['horarios_obj'] = df['horario_completo'].apply(parse_horarios)
+        # Constrói os arrays de horário e as colunas derivadas (uma única passada vetorizada)
+        derivadas = _colunas_de_horario(df['horario_completo'])
+        df[derivadas.columns] = derivadas
 
-        # Mantém apenas linhas com algum horário válido
-        df = df[df['horarios_obj'].map(len) > 0].copy()
+        # Mantém apenas linhas com algum horário válido (todo horário liga o bit do seu dia)
+        df = df[df['DIAS_MASK'] != 0]
 
-        # Adiciona colunas derivadas
-        df['TURNOS'] = df['horarios_obj'].apply(lambda horarios: list(set(get_turno(h) for h in horarios)))
-        df['DIAS'] = df['horarios_obj'].apply(lambda horarios: list(set(h['dia'] for h in horarios)))
+        # Códigos de curso/disciplina e turma para o score
+        grupos = _colunas_de_grupo(df)
+        df[grupos.columns] = grupos
 
         # Identificador estável da linha para persistir seleção
-        def _mk_id(row):
-            return f"{row.get('CODIGO','')}-{row.get('TURMA','')}-{row.get('Dia 1','')}-{row.get('Dia 2','')}"
-        df['ROW_ID'] = df.apply(_mk_id, axis=1).astype(str)
+        df['ROW_ID'] = _mk_row_ids(df)
 
         return df
 
@@ -203,29 +422,79 @@ def carregar_disciplinas(uploaded_file):
         return pd.DataFrame()
 
 
+def carregar_disciplinas_sessao(uploaded_file):
+    """Versão de `carregar_disciplinas` que reaproveita o DataFrame já montado nesta sessão.
+
+    O `st.cache_data` devolve uma cópia desserializada a cada rerun; guardando o resultado em
+    `st.session_state` (chaveado pelo hash do arquivo) os reruns reutilizam o mesmo objeto.
+    O DataFrame guardado já passou por `ensure_computed_columns` e deve ser tratado como somente leitura.
+    """
+    if uploaded_file is None:
+        return pd.DataFrame()
+
+    chave = _hash_arquivo(uploaded_file)
+    em_cache = st.session_state.get("_df_cached")
+    if em_cache is not None and em_cache[0] == chave:
+        return em_cache[1]
+
+    df = carregar_disciplinas(uploaded_file)
+    if not df.empty:
+        df = ensure_computed_columns(df)
+        st.session_state["_df_cached"] = (chave, df)
+    return df
+
+
 def ensure_computed_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Garante que as colunas derivadas existam antes de filtrar."""
     if df is None or df.empty:
         return df
 
-    if 'horarios_obj' not in df.columns:
-        if 'horario_completo' not in df.columns:
-            df = _build_horario_completo(df)
-        df['horarios_obj'] = df['horario_completo'].apply(parse_horarios)
-
-    if 'DIAS' not in df.columns:
-        df['DIAS'] = df['horarios_obj'].apply(lambda horarios: list(set(h['dia'] for h in horarios)))
-    if 'TURNOS' not in df.columns:
-        df['TURNOS'] = df['horarios_obj'].apply(lambda horarios: list(set(get_turno(h) for h in horarios)))
+    if 'horario_completo' not in df.columns:
+        df = _build_horario_completo(df)
+    faltantes = [c for c in ['horarios_arr', 'DIAS', 'TURNOS', 'DIAS_MASK', 'TURNOS_MASK', 'OCUPACAO'] if c not in df.columns]
+    if faltantes:
+        derivadas = _colunas_de_horario(df['horario_completo'])
+        df[faltantes] = derivadas[faltantes]
+    if 'CURSO_DISC_ID' not in df.columns or 'TURMA_ID' not in df.columns:
+        grupos = _colunas_de_grupo(df)
+        df[grupos.columns] = grupos
     if 'ROW_ID' not in df.columns:
-        def _mk_id(row):
-            return f"{row.get('CODIGO','')}-{row.get('TURMA','')}-{row.get('Dia 1','')}-{row.get('Dia 2','')}"
-        df['ROW_ID'] = df.apply(_mk_id, axis=1)
-    df['ROW_ID'] = df['ROW_ID'].astype(str)
+        df['ROW_ID'] = _mk_row_ids(df)
+    elif df['ROW_ID'].dtype != 'int64':
+        df['ROW_ID'] = df['ROW_ID'].astype('int64')
 
     return df
 
 
+def _has_conflict(disciplinas_selecionadas) -> bool:
+    """Indica se algum par de horários se sobrepõe (mesmo critério de `check_conflito`), sem listar os pares.
+
+    Ordena os horários por (dia, início) com `np.lexsort` e compara só vizinhos: entre intervalos de
+    duração positiva, se há alguma sobreposição, então dois adjacentes na ordem também se sobrepõem.
+    Horários de duração nula/negativa só conflitam com um intervalo positivo que os atravesse, o que
+    se verifica pelo maior fim acumulado entre os intervalos que começam antes deles.
+    """
+    if len(disciplinas_selecionadas) < 2:
+        return False
+    horarios = np.concatenate(list(disciplinas_selecionadas['horarios_arr'])).astype(np.int64)
+    dia, ini, fim = horarios[:, 0], horarios[:, 1], horarios[:, 2]
+
+    positivos = fim > ini
+    ordem = np.lexsort((ini[positivos], dia[positivos]))
+    d, i0, f = dia[positivos][ordem], ini[positivos][ordem], fim[positivos][ordem]
+    if np.any((d[1:] == d[:-1]) & (i0[1:] < f[:-1])):
+        return True
+
+    if positivos.all() or not positivos.any():
+        return False
+    # Chaves (dia, minuto) num único inteiro: dias diferentes nunca se misturam
+    escala = int(max(ini.max(), fim.max())) + 1
+    fim_acumulado = np.maximum.accumulate(d * escala + f)
+    pos = np.searchsorted(d * escala + i0, dia[~positivos] * escala + fim[~positivos], side="left") - 1
+    validos = pos >= 0
+    return bool(np.any(fim_acumulado[pos[validos]] > (dia[~positivos] * escala + ini[~positivos])[validos]))
+
+
 def check_conflito(disciplinas_selecionadas):
     """Verifica conflitos entre as disciplinas selecionadas.
 
@@ -234,45 +503,46 @@ def check_conflito(disciplinas_selecionadas):
         Onde cada tupla é:
         (disciplina1, inicio1, disciplina2, inicio2, dia, fim1, fim2, turma1, turma2)
     """
-    from itertools import combinations as _comb
-    conflitos = []
     try:
         if getattr(disciplinas_selecionadas, "empty", False) or len(disciplinas_selecionadas) < 2:
             return False, []
     except TypeError:
         pass
 
-    todos_horarios = []
-    for _, disc in disciplinas_selecionadas.iterrows():
-        horarios = disc.get('horarios_obj') or []
-        for horario in horarios:
-            if not horario or 'inicio' not in horario or 'fim' not in horario or 'dia' not in horario:
-                continue
-            todos_horarios.append({
-                "disciplina": disc.get('DISCIPLINA', 'N/A'),
-                "turma": disc.get('TURMA', 'N/A'),
-                "dia": horario['dia'],
-                "inicio": horario['inicio'],
-                "fim": horario['fim']
-            })
-
-    for h1, h2 in _comb(todos_horarios, 2):
-        if h1['dia'] != h2['dia']:
-            continue
-        if h1['inicio'] < h2['fim'] and h2['inicio'] < h1['fim']:
-            conflitos.append((
-                h1['disciplina'],
-                h1['inicio'].strftime("%H:%M"),
-                h2['disciplina'],
-                h2['inicio'].strftime("%H:%M"),
-                h1['dia'],
-                h1['fim'].strftime("%H:%M"),
-                h2['fim'].strftime("%H:%M"),
-                h1.get('turma', 'N/A'),
-                h2.get('turma', 'N/A'),
-            ))
-
-    return (len(conflitos) > 0), conflitos
+    # Caso comum (seleção sem conflitos) resolvido pela varredura, sem a matriz de pares
+    if not _has_conflict(disciplinas_selecionadas):
+        return False, []
+
+    arrays = list(disciplinas_selecionadas['horarios_arr'])
+    horarios = np.concatenate(arrays)
+    linha = np.repeat(np.arange(len(arrays)), [len(h) for h in arrays])
+    dia, ini, fim = horarios[:, 0], horarios[:, 1], horarios[:, 2]
+
+    # Todos os pares (i < j) de horários de uma vez: mesmo dia e intervalos sobrepostos
+    sobrepoe = (dia[:, None] == dia[None, :]) & (ini[:, None] < fim[None, :]) & (ini[None, :] < fim[:, None])
+    pares = np.argwhere(np.triu(sobrepoe, k=1))
+    if len(pares) == 0:
+        return False, []
+
+    # Metadados por horário, apenas para formatar o relatório
+    disciplinas = disciplinas_selecionadas.get('DISCIPLINA', pd.Series('N/A', index=disciplinas_selecionadas.index)).to_numpy(dtype=object)[linha]
+    turmas = disciplinas_selecionadas.get('TURMA', pd.Series('N/A', index=disciplinas_selecionadas.index)).to_numpy(dtype=object)[linha]
+
+    conflitos = [
+        (
+            disciplinas[i],
+            _fmt_minutos(ini[i]),
+            disciplinas[j],
+            _fmt_minutos(ini[j]),
+            DIAS_NOMES[dia[i]],
+            _fmt_minutos(fim[i]),
+            _fmt_minutos(fim[j]),
+            turmas[i],
+            turmas[j],
+        )
+        for i, j in pares
+    ]
+    return True, conflitos
 
 def conflitos_com_turma_legenda(conflitos):
     """Formata conflitos incluindo TURMA para exibição."""
@@ -282,47 +552,393 @@ def conflitos_com_turma_legenda(conflitos):
     return linhas
 
 
-def dias_totais_da_grade(df_grade: pd.DataFrame) -> int:
-    """Conta o número de dias distintos na combinação."""
-    dias = set()
-    for _, r in df_grade.iterrows():
-        for d in r.get("DIAS", []):
-            dias.add(d)
-    return len(dias)
-
-
-def score_combo(df_grade: pd.DataFrame, turnos_pref: list, alvo_qtd_dias) -> int:
-    """Calcula score de uma combinação para ordenação."""
-    score = 0
-    if turnos_pref:
-        for _, r in df_grade.iterrows():
-            turnos_disc = r.get("TURNOS", [])
-            if any(t in turnos_pref for t in turnos_disc):
-                score += 1
-    if alvo_qtd_dias in {2, 3, 4}:
-        if dias_totais_da_grade(df_grade) == alvo_qtd_dias:
-            score += 2
-    if {'CURSO', 'DISCIPLINA', 'TURMA'}.issubset(df_grade.columns):
-        grp = df_grade.groupby(['CURSO', 'DISCIPLINA'])['TURMA'].nunique()
-        extras = (grp[grp > 1] - 1).sum()
-        if pd.notna(extras):
-            score += int(extras)
-    return score
-
-
-def turnos_da_grade(df_grade: pd.DataFrame) -> set:
-    """Retorna o conjunto de turnos presentes na combinação."""
-    turnos_set = set()
-    for _, r in df_grade.iterrows():
-        for t in r.get("TURNOS", []):
-            if t:
-                turnos_set.add(t)
-    return turnos_set
-
-
-def is_turno_set_permitido(turnos_set: set) -> bool:
-    """Aceita somente dois turnos consecutivos: {Manhã, Tarde} ou {Tarde, Noite}."""
-    return turnos_set in ({"Manhã", "Tarde"}, {"Tarde", "Noite"})
+def _horarios_irregulares(df: pd.DataFrame) -> np.ndarray:
+    """Linhas que a máscara OCUPACAO não representa exatamente.
+
+    São as que têm algum horário de duração nula ou negativa (vazio na máscara, mas que ainda pode
+    cair dentro de outro horário) ou horários da própria linha sobrepostos (o OR da máscara os une).
+    """
+    arrays = list(df["horarios_arr"])
+    if not arrays:
+        return np.zeros(0, dtype=bool)
+    horarios = np.concatenate(arrays).astype(np.int64)
+    linha = np.repeat(np.arange(len(arrays)), [len(h) for h in arrays])
+    duracao = horarios[:, 2] - horarios[:, 1]
+    degenerada = np.bincount(linha, weights=duracao <= 0, minlength=len(arrays)) > 0
+    minutos = np.bincount(linha, weights=np.clip(duracao, 0, None), minlength=len(arrays)).astype(np.int64)
+    sobreposta = minutos != np.array([int(o).bit_count() for o in df["OCUPACAO"]], dtype=np.int64)
+    return degenerada | sobreposta
+
+
+def _matriz_conflitos(df: pd.DataFrame) -> np.ndarray:
+    """Matriz booleana (n, n): True quando as linhas i e j não podem estar na mesma grade.
+
+    Mesmo critério de `check_conflito` (mesmo dia e `ini_a < fim_b and ini_b < fim_a`): AND das máscaras
+    OCUPACAO e, para as linhas de `_horarios_irregulares`, o teste de intervalos contra todos os horários.
+    Uma linha cujos próprios horários se sobrepõem conflita com todas as outras.
+    """
+    ocupacao = df["OCUPACAO"].to_numpy(dtype=object)
+    conflitos = np.bitwise_and.outer(ocupacao, ocupacao) != 0
+
+    irregulares = np.flatnonzero(_horarios_irregulares(df))
+    if len(irregulares):
+        arrays = list(df["horarios_arr"])
+        horarios = np.concatenate(arrays).astype(np.int64)
+        linha = np.repeat(np.arange(len(arrays)), [len(h) for h in arrays])
+        dia, ini, fim = horarios[:, 0], horarios[:, 1], horarios[:, 2]
+        for i in irregulares:
+            proprios = np.flatnonzero(linha == i)
+            sobrepoe = ((dia[proprios, None] == dia[None, :])
+                        & (ini[proprios, None] < fim[None, :])
+                        & (ini[None, :] < fim[proprios, None]))
+            sobrepoe[np.arange(len(proprios)), proprios] = False  # cada horário consigo mesmo
+            outras = np.unique(linha[np.nonzero(sobrepoe)[1]])
+            if i in outras:
+                outras = np.arange(len(arrays))
+            conflitos[i, outras] = True
+            conflitos[outras, i] = True
+
+    np.fill_diagonal(conflitos, False)
+    return conflitos
+
+
+def _distintos_por_linha(valores: np.ndarray, ordenado: bool = False) -> np.ndarray:
+    """Quantidade de valores distintos (>= 0) em cada linha de uma matriz; negativos são ignorados.
+
+    Com `ordenado=True` as linhas já vêm em ordem crescente e a ordenação é pulada.
+    """
+    ordenados = valores if ordenado else np.sort(valores, axis=1)
+    novos = ordenados[:, 1:] != ordenados[:, :-1]
+    novos = np.concatenate([np.ones((len(ordenados), 1), dtype=bool), novos], axis=1)
+    return np.count_nonzero(novos & (ordenados >= 0), axis=1)
+
+
+def avaliar_combinacoes(base_df: pd.DataFrame, combinacoes: list, turnos_pref: list, alvo_qtd_dias):
+    """Dias totais e score de todas as combinações de uma vez (regra de pontuação da aplicação).
+
+    Score: +1 por disciplina em turno preferido, +2 se os dias totais batem com `alvo_qtd_dias` e +1 por
+    turma extra de um mesmo grupo (CURSO, DISCIPLINA). A mesma regra está em `_kernels.avaliar_combinacoes`
+    e nos limites de `melhores_combinacoes`: mudou aqui, mude lá.
+
+    `combinacoes` são listas de rótulos de `base_df`; as máscaras de cada linha são reunidas numa
+    matriz (combinações x disciplinas), completada com -1, e reduzidas ao longo das colunas.
+    Retorna dois arrays int alinhados com `combinacoes`.
+    """
+    if not combinacoes:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    tamanhos = np.fromiter((len(combo) for combo in combinacoes), dtype=np.int64, count=len(combinacoes))
+    indice = {r: i for i, r in enumerate(base_df.index)}
+    posicao = np.fromiter((indice[r] for combo in combinacoes for r in combo), dtype=np.int64, count=int(tamanhos.sum()))
+    pref_mask = reduce(or_, (TURNO_BITS.get(t, 0) for t in turnos_pref or []), 0)
+    if alvo_qtd_dias not in {2, 3, 4}:
+        alvo_qtd_dias = None
+
+    if _kernels.DISPONIVEL:
+        # Laço compilado sobre as combinações concatenadas (ver _kernels.avaliar_combinacoes)
+        return _kernels.avaliar_combinacoes(
+            posicao,
+            np.concatenate([[0], np.cumsum(tamanhos)]),
+            base_df["DIAS_MASK"].to_numpy(dtype=np.int64),
+            base_df["TURNOS_MASK"].to_numpy(dtype=np.int64),
+            pref_mask,
+            alvo_qtd_dias or 0,
+            base_df["CURSO_DISC_ID"].to_numpy(dtype=np.int64),
+            base_df["TURMA_ID"].to_numpy(dtype=np.int64),
+        )
+
+    validos = np.arange(tamanhos.max()) < tamanhos[:, None]
+    idx = np.full(validos.shape, -1, dtype=np.int64)
+    idx[validos] = posicao
+
+    def _coluna(nome, vazio):
+        valores = base_df[nome].to_numpy()
+        return np.where(validos, valores[idx], vazio)
+
+    dias_mask = np.bitwise_or.reduce(_coluna("DIAS_MASK", 0).astype(np.uint8), axis=1)
+    dias = np.unpackbits(dias_mask[:, None], axis=1).sum(axis=1).astype(int)
+
+    score = np.zeros(len(combinacoes), dtype=int)
+    if pref_mask:
+        score += np.count_nonzero(_coluna("TURNOS_MASK", 0).astype(np.int64) & pref_mask, axis=1)
+    if alvo_qtd_dias:
+        score += 2 * (dias == alvo_qtd_dias)
+
+    # +1 por turma extra de uma mesma (CURSO, DISCIPLINA): pares distintos - grupos distintos
+    grupo = _coluna("CURSO_DISC_ID", -1).astype(np.int64)
+    turma = _coluna("TURMA_ID", -1).astype(np.int64)
+    contados = (grupo >= 0) & (turma >= 0)
+    # (código do par = grupo * base + turma); como o par ordenado também ordena o grupo (par // base),
+    # uma única ordenação serve às duas contagens
+    base = max(int(turma.max()), 0) + 1  # sem nenhuma TURMA_ID, turma.max() é -1
+    par = np.sort(np.where(contados, grupo * base + turma, -1), axis=1)
+    grupo = np.where(par >= 0, par // base, -1)
+    score += _distintos_por_linha(par, ordenado=True) - _distintos_por_linha(grupo, ordenado=True)
+    return dias, score
+
+
+def is_turno_set_permitido(turnos_mask: int) -> bool:
+    """Aceita somente dois turnos consecutivos: {Manhã, Tarde} ou {Tarde, Noite} (máscara de TURNO_BITS)."""
+    return turnos_mask in TURNOS_PERMITIDOS_MASK
+
+
+def _candidatos_compativeis(dias_mask: list, turnos_mask: list, alvo_qtd_dias) -> tuple:
+    """Para cada máscara de turnos / de dias acumulada, as posições que ainda podem entrar na combinação.
+
+    Retorna `(por_turnos, por_dias)`: listas de bitmasks (bit j = posição j) indexadas pela máscara de
+    turnos (regra de turnos consecutivos) e pela de dias (sem passar de `alvo_qtd_dias`; todas, se não
+    houver alvo). Um AND com as duas descarta de uma vez os candidatos inviáveis de um nó da busca.
+    """
+    n = len(dias_mask)
+    por_turnos = [reduce(or_, (1 << j for j in range(n) if TURNOS_VIAVEIS[m | turnos_mask[j]]), 0)
+                  for m in range(len(TURNOS_VIAVEIS))]
+    if alvo_qtd_dias:
+        por_dias = [reduce(or_, (1 << j for j in range(n) if (m | dias_mask[j]).bit_count() <= alvo_qtd_dias), 0)
+                    for m in range(1 << len(DIAS_NOMES))]
+    else:
+        por_dias = [(1 << n) - 1] * (1 << len(DIAS_NOMES))
+    return por_turnos, por_dias
+
+
+def _preparar_busca(base_df: pd.DataFrame, obrig_idx: set, alvo_qtd_dias):
+    """Estado inicial comum às buscas de combinações (`gerar_combinacoes` / `melhores_combinacoes`).
+
+    Retorna None se as obrigatórias já tornam a busca inviável (conflitam entre si, violam a regra
+    de turnos ou excedem `alvo_qtd_dias`); caso contrário, a tupla
+    `(rotulos, conflitos, vizinhos, dias_mask, turnos_mask, pos_obrig, candidatos, dias, turnos, alvo_qtd_dias)`,
+    com as máscaras sobre as posições de `base_df` como inteiros Python (bit j = posição j).
+    """
+    rotulos = list(base_df.index)
+    n = len(rotulos)
+
+    # Vizinhança de conflitos de cada linha como bitmask sobre as posições
+    conflitos = _matriz_conflitos(base_df)
+    vizinhos = [int.from_bytes(np.packbits(linha, bitorder="little").tobytes(), "little") for linha in conflitos]
+    dias_mask = [int(m) for m in base_df["DIAS_MASK"]]
+    turnos_mask = [int(m) for m in base_df["TURNOS_MASK"]]
+    if alvo_qtd_dias not in {2, 3, 4}:
+        alvo_qtd_dias = None
+
+    # Estado inicial: as obrigatórias
+    posicao = {r: i for i, r in enumerate(rotulos)}
+    pos_obrig = [posicao[r] for r in sorted(obrig_idx)]
+    bits_obrig = reduce(or_, (1 << p for p in pos_obrig), 0)
+    if any(vizinhos[p] & bits_obrig for p in pos_obrig):
+        return None  # obrigatórias conflitam entre si
+
+    candidatos = ((1 << n) - 1) & ~bits_obrig
+    dias = turnos = 0
+    for p in pos_obrig:
+        candidatos &= ~vizinhos[p]
+        dias |= dias_mask[p]
+        turnos |= turnos_mask[p]
+    if not TURNOS_VIAVEIS[turnos] or (alvo_qtd_dias and dias.bit_count() > alvo_qtd_dias):
+        return None
+    return rotulos, conflitos, vizinhos, dias_mask, turnos_mask, pos_obrig, candidatos, dias, turnos, alvo_qtd_dias
+
+
+def gerar_combinacoes(base_df: pd.DataFrame, obrig_idx: set, tamanhos, alvo_qtd_dias=None,
+                      limite: int = MAX_COMBINACOES) -> tuple:
+    """Enumera as combinações válidas de `base_df` que contêm todas as linhas de `obrig_idx`.
+
+    Busca em profundidade sobre o grafo de conflitos: uma disciplina só estende a combinação
+    parcial se não conflitar com nenhuma já escolhida. Em cada nó, os candidatos que violariam a
+    regra de turnos consecutivos ou excederiam `alvo_qtd_dias` saem antes (AND com as tabelas de
+    `_candidatos_compativeis`), e ramos sem candidatos suficientes para chegar ao menor tamanho
+    pedido são podados. Visita no máximo `limite` nós.
+
+    Retorna `(combinacoes, completa)`: listas de rótulos de `base_df` (obrigatórias primeiro), por
+    tamanho crescente e, dentro de cada tamanho, na mesma ordem de `itertools.combinations`; e
+    False se a busca parou no `limite` (há combinações válidas que não foram enumeradas).
+    """
+    tamanhos = set(tamanhos)
+    if base_df.empty or not tamanhos:
+        return [], True
+    estado = _preparar_busca(base_df, obrig_idx, alvo_qtd_dias)
+    if estado is None:
+        return [], True
+    rotulos, conflitos, vizinhos, dias_mask, turnos_mask, pos_obrig, candidatos, dias, turnos, alvo_qtd_dias = estado
+    n = len(rotulos)
+    obrig_rotulos = [rotulos[p] for p in pos_obrig]
+    por_turnos, por_dias = _candidatos_compativeis(dias_mask, turnos_mask, alvo_qtd_dias)
+
+    max_extras = max(tamanhos) - len(pos_obrig)
+    min_extras = min(tamanhos) - len(pos_obrig)
+    resultados = []
+    visitados = 0
+    escolhidos = []  # pilha única da busca (push/pop); só as combinações aceitas viram cópias
+
+    def _estender(candidatos, dias, turnos):
+        nonlocal visitados
+        if visitados >= limite:
+            return
+        visitados += 1
+
+        if (len(pos_obrig) + len(escolhidos) in tamanhos
+                and is_turno_set_permitido(turnos)
+                and (alvo_qtd_dias is None or dias.bit_count() == alvo_qtd_dias)):
+            resultados.append(tuple(escolhidos))
+        if len(escolhidos) >= max_extras:
+            return
+
+        # Filtros baratos primeiro: turnos e dias descartam candidatos em bloco, antes de qualquer descida
+        candidatos &= por_turnos[turnos] & por_dias[dias]
+        while candidatos:
+            # Limite: nem usando todos os candidatos restantes se alcança o menor tamanho pedido
+            if len(escolhidos) + candidatos.bit_count() < min_extras:
+                return
+            bit = candidatos & -candidatos
+            candidatos ^= bit
+            j = bit.bit_length() - 1
+            escolhidos.append(j)
+            _estender(candidatos & ~vizinhos[j], dias | dias_mask[j], turnos | turnos_mask[j])
+            escolhidos.pop()
+            if visitados >= limite:
+                return
+
+    if _kernels.DISPONIVEL:
+        # Mesma busca, compilada pelo numba (ver _kernels.buscar_combinacoes)
+        aceita_tamanho = np.zeros(n + 1, dtype=bool)
+        aceita_tamanho[[t for t in tamanhos if 0 <= t <= n]] = True
+        def _como_matriz(tabela):
+            return np.array([[m >> j & 1 for j in range(n)] for m in tabela], dtype=bool)
+
+        itens, limites, visitados = _kernels.buscar_combinacoes(
+            conflitos,
+            np.array([(candidatos & por_turnos[turnos] & por_dias[dias]) >> j & 1 for j in range(n)], dtype=bool),
+            np.array(dias_mask, dtype=np.int64),
+            np.array(turnos_mask, dtype=np.int64),
+            dias,
+            turnos,
+            len(pos_obrig),
+            aceita_tamanho,
+            min_extras,
+            max_extras,
+            alvo_qtd_dias or 0,
+            _como_matriz(por_turnos),
+            _como_matriz(por_dias),
+            np.array([is_turno_set_permitido(m) for m in range(len(TURNOS_VIAVEIS))]),
+            limite,
+        )
+        # Pré-ordem -> ordem por tamanho (estável), como na versão em Python abaixo
+        ordem = np.argsort(np.diff(limites), kind="stable").tolist()
+        itens_rotulos = [rotulos[j] for j in itens.tolist()]
+        limites = limites.tolist()
+        return [obrig_rotulos + itens_rotulos[limites[a]:limites[a + 1]] for a in ordem], visitados < limite
+
+    _estender(candidatos, dias, turnos)
+
+    # A busca visita os prefixos em pré-ordem; ordenar (estável) por tamanho reproduz a ordem por k
+    resultados.sort(key=len)
+    return [obrig_rotulos + [rotulos[j] for j in escolhidos] for escolhidos in resultados], visitados < limite
+
+
+def melhores_combinacoes(base_df: pd.DataFrame, obrig_idx: set, tamanhos, alvo_qtd_dias, turnos_pref: list,
+                         quantidade: int = 4, limite: int = MAX_COMBINACOES) -> list:
+    """As `quantidade` combinações válidas de maior score (como em `avaliar_combinacoes`), por branch and bound.
+
+    Complementa `gerar_combinacoes` quando ela para no `limite`: aquela enumera em ordem de posição
+    e as de maior score podem ficar de fora. Aqui a busca em profundidade tenta primeiro os
+    candidatos que mais podem somar ao score e mantém as `quantidade` melhores num heap; um ramo é
+    podado quando nem o seu teto (score parcial + o máximo que as vagas restantes ainda podem
+    render + bônus do alvo de dias) supera a pior delas. Visita no máximo `limite` nós; se parar
+    antes, devolve as melhores encontradas até ali.
+
+    Retorna listas de rótulos de `base_df` (obrigatórias primeiro), por score decrescente.
+    """
+    tamanhos = set(tamanhos)
+    if base_df.empty or not tamanhos or quantidade <= 0:
+        return []
+    estado = _preparar_busca(base_df, obrig_idx, alvo_qtd_dias)
+    if estado is None:
+        return []
+    rotulos, _, vizinhos, dias_mask, turnos_mask, pos_obrig, candidatos, dias, turnos, alvo_qtd_dias = estado
+    n = len(rotulos)
+    max_extras = max(tamanhos) - len(pos_obrig)
+    min_extras = min(tamanhos) - len(pos_obrig)
+
+    # Quanto cada posição pode somar: +1 se for de turno preferido, +1 se o seu grupo (CURSO, DISCIPLINA)
+    # tiver mais de uma turma (pode render turma extra)
+    pref_mask = reduce(or_, (TURNO_BITS.get(t, 0) for t in turnos_pref or []), 0)
+    grupo = base_df["CURSO_DISC_ID"].tolist()
+    turma = base_df["TURMA_ID"].tolist()
+    turmas_por_grupo = {}
+    for g, t in zip(grupo, turma):
+        if g >= 0 and t >= 0:
+            turmas_por_grupo.setdefault(g, set()).add(t)
+    valor = [bool(turnos_mask[j] & pref_mask) + (len(turmas_por_grupo.get(grupo[j], ())) > 1) for j in range(n)]
+    bits_valor = [reduce(or_, (1 << j for j in range(n) if valor[j] == v), 0) for v in (2, 1, 0)]
+    por_turnos, por_dias = _candidatos_compativeis(dias_mask, turnos_mask, alvo_qtd_dias)
+    bonus_alvo = 2 if alvo_qtd_dias else 0
+
+    def _somar(j, score, pares, grupos):
+        """Score, pares e grupos após incluir a posição j (+1 turno preferido, +1 turma extra)."""
+        score += 1 if turnos_mask[j] & pref_mask else 0
+        par = (grupo[j], turma[j])
+        if par[0] >= 0 and par[1] >= 0 and par not in pares:
+            score += 1 if par[0] in grupos else 0
+            pares, grupos = pares | {par}, grupos | {par[0]}
+        return score, pares, grupos
+
+    def _teto(n_escolhidos, candidatos, score):
+        vagas = min(max_extras - n_escolhidos, candidatos.bit_count())
+        dois = min(vagas, (candidatos & bits_valor[0]).bit_count())
+        um = min(vagas - dois, (candidatos & bits_valor[1]).bit_count())
+        return score + bonus_alvo + 2 * dois + um
+
+    melhores = []  # heap (score, -ordem de descoberta, escolhidos): a pior das melhores no topo
+    descobertas = 0
+    visitados = 0
+    escolhidos = []  # pilha única da busca; só as combinações que entram no heap viram cópias
+
+    def _estender(candidatos, dias, turnos, score, pares, grupos):
+        nonlocal descobertas, visitados
+        if visitados >= limite:
+            return
+        visitados += 1
+
+        if (len(pos_obrig) + len(escolhidos) in tamanhos
+                and is_turno_set_permitido(turnos)
+                and (alvo_qtd_dias is None or dias.bit_count() == alvo_qtd_dias)):
+            # Com score igual, a mais antiga fica (tem -ordem maior); basta comparar o score
+            descobertas += 1
+            total = score + bonus_alvo
+            if len(melhores) < quantidade:
+                heapq.heappush(melhores, (total, -descobertas, tuple(escolhidos)))
+            elif total > melhores[0][0]:
+                heapq.heapreplace(melhores, (total, -descobertas, tuple(escolhidos)))
+        if len(escolhidos) >= max_extras:
+            return
+
+        # Filtros baratos primeiro (turnos e dias, em bloco); depois os candidatos de maior valor,
+        # cada um saindo de `candidatos` depois de tentado
+        candidatos &= por_turnos[turnos] & por_dias[dias]
+        for bits in (candidatos & bits_valor[0], candidatos & bits_valor[1], candidatos & bits_valor[2]):
+            while bits:
+                if len(escolhidos) + candidatos.bit_count() < min_extras:
+                    return
+                if len(melhores) == quantidade and _teto(len(escolhidos), candidatos, score) <= melhores[0][0]:
+                    return
+                bit = bits & -bits
+                bits ^= bit
+                candidatos ^= bit
+                j = bit.bit_length() - 1
+                escolhidos.append(j)
+                _estender(candidatos & ~vizinhos[j], dias | dias_mask[j], turnos | turnos_mask[j],
+                          *_somar(j, score, pares, grupos))
+                escolhidos.pop()
+                if visitados >= limite:
+                    return
+
+    # As obrigatórias entram no score inicial
+    score, pares, grupos = 0, frozenset(), frozenset()
+    for p in pos_obrig:
+        score, pares, grupos = _somar(p, score, pares, grupos)
+    _estender(candidatos, dias, turnos, score, pares, grupos)
+
+    obrig_rotulos = [rotulos[p] for p in pos_obrig]
+    return [obrig_rotulos + [rotulos[j] for j in sorted(escolhidos)]
+            for _, _, escolhidos in sorted(melhores, reverse=True)]
 
 
 # --- INTERFACE DA APLICAÇÃO WEB ---
@@ -341,7 +957,7 @@ with st.sidebar:
     )
     st.divider()
 
-    df_disciplinas = carregar_disciplinas(uploaded_file)
+    df_disciplinas = carregar_disciplinas_sessao(uploaded_file)
 
     # Botão de limpeza geral dos filtros da Etapa 1
     limpar = st.button("Limpar filtros (Etapa 1)", use_container_width=True)
@@ -385,81 +1001,95 @@ if uploaded_file is None:
 elif df_disciplinas.empty:
     st.error("Não foi possível carregar as disciplinas do arquivo. Verifique o formato.")
 else:
-    # Estado de seleção persistente (Etapa 1)
-    if "selecionados_ids" not in st.session_state:
-        st.session_state["selecionados_ids"] = []
-
-    # Base completa com colunas derivadas e ROW_ID
-    df_base = ensure_computed_columns(df_disciplinas.copy())
+    # Base completa com colunas derivadas e ROW_ID (já calculada no carregamento; somente leitura)
+    df_base = df_disciplinas
 
     if "ROW_ID" not in df_base.columns:
         df_base = df_base.reset_index(drop=False).rename(columns={"index": "ROW_ID"})
-    df_base["ROW_ID"] = df_base["ROW_ID"].astype(str)
-
-    # Aplica filtros da Etapa 1
-    df_filtrado = df_base.copy()
-    if filtro_disciplinas and 'DISCIPLINA' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['DISCIPLINA'].isin(filtro_disciplinas)]
-    if filtro_codigos and 'CODIGO' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['CODIGO'].isin(filtro_codigos)]
-    if filtro_turmas and 'TURMA' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['TURMA'].isin(filtro_turmas)]
-    if filtro_cursos and 'CURSO' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['CURSO'].isin(filtro_cursos)]
-    if filtro_turnos and 'TURNOS' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['TURNOS'].apply(lambda turnos: any(t in filtro_turnos for t in turnos))]
-    if filtro_dias and 'DIAS' in df_filtrado.columns:
-        df_filtrado = df_filtrado[
-            df_filtrado['DIAS'].apply(lambda dias_disciplina: set(filtro_dias).issubset(set(dias_disciplina)))
+        df_base["ROW_ID"] = df_base["ROW_ID"].astype('int64')
+
+    # Versão dos dados: hash do arquivo carregado (as demais chaves de cache partem dela)
+    versao_dados = st.session_state["_df_cached"][0]
+
+    # Filtros e ordenação só são refeitos quando o arquivo ou algum filtro muda;
+    # cliques que não mexem nos filtros reaproveitam o df_filtrado guardado na sessão
+    chave_filtros = (
+        versao_dados,
+        frozenset(filtro_disciplinas),
+        frozenset(filtro_codigos),
+        frozenset(filtro_turmas),
+        frozenset(filtro_cursos),
+        frozenset(filtro_turnos),
+        frozenset(filtro_dias),
+    )
+    filtrado_cache = st.session_state.get("_df_filtrado_cached")
+    if filtrado_cache is not None and filtrado_cache[0] == chave_filtros:
+        df_filtrado = filtrado_cache[1]
+    else:
+        # Aplica filtros da Etapa 1: as condições viram uma única máscara booleana e uma única seleção
+        mascaras = [
+            df_base[coluna].isin(filtro).to_numpy()
+            for filtro, coluna in (
+                (filtro_disciplinas, 'DISCIPLINA'),
+                (filtro_codigos, 'CODIGO'),
+                (filtro_turmas, 'TURMA'),
+                (filtro_cursos, 'CURSO'),
+            )
+            if filtro and coluna in df_base.columns
         ]
+        if filtro_turnos and 'TURNOS_MASK' in df_base.columns:
+            # Algum dos turnos escolhidos
+            bits_turnos = reduce(or_, (TURNO_BITS.get(t, 0) for t in filtro_turnos), 0)
+            mascaras.append((df_base['TURNOS_MASK'].to_numpy() & bits_turnos) != 0)
+        if filtro_dias and 'DIAS_MASK' in df_base.columns:
+            # Todos os dias escolhidos (um dia desconhecido não é atendido por nenhuma linha)
+            if all(d in _DIA_BITS for d in filtro_dias):
+                bits_dias = reduce(or_, (_DIA_BITS[d] for d in filtro_dias), 0)
+                mascaras.append((df_base['DIAS_MASK'].to_numpy() & bits_dias) == bits_dias)
+            else:
+                mascaras.append(np.zeros(len(df_base), dtype=bool))
+        df_filtrado = df_base[np.logical_and.reduce(mascaras)] if mascaras else df_base
+
+        # Ordem estável: códigos de ordenação da base (calculados uma vez por arquivo) + np.lexsort
+        ordem_estavel = [c for c in ['DISCIPLINA', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID'] if c in df_filtrado.columns]
+        if ordem_estavel:
+            ordem_cache = st.session_state.get("_ordem_cached")
+            if ordem_cache is None or ordem_cache[0] != (versao_dados, ordem_estavel):
+                ordem_cache = ((versao_dados, ordem_estavel), _codigos_de_ordenacao(df_base, ordem_estavel))
+                st.session_state["_ordem_cached"] = ordem_cache
+            codigos = ordem_cache[1][:, df_base.index.get_indexer(df_filtrado.index)]
+            df_filtrado = df_filtrado.iloc[np.lexsort(codigos[::-1])]
+
+        st.session_state["_df_filtrado_cached"] = (chave_filtros, df_filtrado)
 
     # ETAPA 1: Tabela e seleção livre
     st.header("Etapa 1 • Ofertas Filtradas")
     st.markdown("Selecione livremente qualquer número de disciplinas. Conflitos não são validados nesta etapa.")
 
-    selected_ids = set(map(str, st.session_state.get("selecionados_ids", [])))
-    df_filtrado = df_filtrado.copy()
-    df_filtrado["ROW_ID"] = df_filtrado["ROW_ID"].astype(str)
-
-    # Garante existência do ROW_ID
-    if "ROW_ID" not in df_filtrado.columns:
-        if df_filtrado.index.isin(df_base.index).all():
-            df_filtrado["ROW_ID"] = df_base.loc[df_filtrado.index, "ROW_ID"].astype(str)
-        else:
-            df_filtrado = df_filtrado.reset_index(drop=True)
-            df_filtrado["ROW_ID"] = df_filtrado.index.astype(str)
-
-    # Coluna de seleção baseada no estado
-    df_filtrado["Selecionar"] = df_filtrado["ROW_ID"].isin(selected_ids)
+    # Estado de seleção persistente (Etapa 1): o próprio set da sessão, alterado no lugar
+    selected_ids = st.session_state["selecionados_ids"]
 
-    # Colunas a exibir
-    colunas_para_exibir = ['Selecionar', 'DISCIPLINA', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID']
+    # Colunas a exibir (além de 'Selecionar')
+    colunas_para_exibir = ['DISCIPLINA', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID']
     colunas_existentes = [col for col in colunas_para_exibir if col in df_filtrado.columns]
 
-    # Ordem estável
-    ordem_estavel = [c for c in ['DISCIPLINA', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID'] if c in df_filtrado.columns]
-    if ordem_estavel:
-        df_filtrado.sort_values(by=ordem_estavel, inplace=True, kind="mergesort")
-
-    # View para o editor
+    # View para o editor: única cópia, pois recebe a coluna de seleção baseada no estado
     df_view = df_filtrado[colunas_existentes].copy()
-    df_view["ROW_ID"] = df_view["ROW_ID"].astype(str)
+    df_view.insert(0, "Selecionar", df_view["ROW_ID"].isin(selected_ids))
     df_view = df_view.set_index("ROW_ID", drop=False)
 
     # Ações de seleção em massa (operam sobre linhas visíveis)
-    current_visible_ids = df_view["ROW_ID"].astype(str).tolist()
+    current_visible_ids = df_view["ROW_ID"].tolist()
     a1, a2 = st.columns(2)
     with a1:
         if st.button("Selecionar todos (visíveis)", use_container_width=True):
-            new_state = set(map(str, st.session_state.get("selecionados_ids", [])))
-            new_state |= set(current_visible_ids)
-            st.session_state["selecionados_ids"] = list(new_state)
+            selected_ids |= set(current_visible_ids)
+            _marcar_selecao_alterada()
             st.rerun()
     with a2:
         if st.button("Limpar seleção (visíveis)", use_container_width=True):
-            new_state = set(map(str, st.session_state.get("selecionados_ids", [])))
-            new_state -= set(current_visible_ids)
-            st.session_state["selecionados_ids"] = list(new_state)
+            selected_ids -= set(current_visible_ids)
+            _marcar_selecao_alterada()
             st.rerun()
 
     column_config = {
@@ -471,6 +1101,7 @@ else:
     }
     for c in [c for c in df_view.columns if c != "Selecionar"]:
         column_config[c] = st.column_config.Column(c, disabled=True)
+    column_config["ROW_ID"] = None  # chave interna (hash): fica no DataFrame, mas não é exibida
 
     # FORM: evita reruns durante os cliques e consolida no submit
     with st.form("form_editor_selecao", clear_on_submit=False):
@@ -487,21 +1118,19 @@ else:
     # Atualiza estado somente no submit (estável e previsível)
     if submitted and not df_editado.empty:
         if "ROW_ID" in df_editado.columns:
-            current_visible_ids = df_editado["ROW_ID"].astype(str).tolist()
-            selected_in_view_ids = set(df_editado.loc[df_editado["Selecionar"], "ROW_ID"].astype(str).tolist())
+            current_visible_ids = df_editado["ROW_ID"].astype('int64').tolist()
+            selected_in_view_ids = set(df_editado.loc[df_editado["Selecionar"], "ROW_ID"].astype('int64').tolist())
         else:
-            current_visible_ids = list(df_editado.index.astype(str))
-            selected_in_view_ids = set(df_editado.index[df_editado["Selecionar"]].astype(str).tolist())
+            current_visible_ids = df_editado.index.astype('int64').tolist()
+            selected_in_view_ids = set(df_editado.index[df_editado["Selecionar"]].astype('int64').tolist())
 
-        new_state = set(map(str, st.session_state.get("selecionados_ids", [])))
-        new_state -= set(current_visible_ids)
-        new_state |= selected_in_view_ids
-        st.session_state["selecionados_ids"] = list(new_state)
+        selected_ids -= set(current_visible_ids)
+        selected_ids |= selected_in_view_ids
+        _marcar_selecao_alterada()
         st.success("Seleção aplicada.")
 
     # Seleção corrente (DataFrame)
-    disciplinas_selecionadas_ids = set(map(str, st.session_state.get("selecionados_ids", [])))
-    selecionadas_full = df_base[df_base["ROW_ID"].astype(str).isin(disciplinas_selecionadas_ids)].copy()
+    selecionadas_full = df_base[df_base["ROW_ID"].isin(selected_ids)]
 
     # Navegação do fluxo: Etapa 1 → Etapa 2
     st.divider()
@@ -514,7 +1143,8 @@ else:
             _go_to_step(2)
     with nav_col2:
         if st.button("Reiniciar fluxo", use_container_width=True):
-            st.session_state["selecionados_ids"] = []
+            st.session_state["selecionados_ids"] = set()
+            _marcar_selecao_alterada()
             st.session_state["fixos_ids"] = set()
             st.session_state["confirmado"] = False
             st.session_state["mapa_grupos_fixas"] = {}
@@ -530,16 +1160,43 @@ else:
         if selecionadas_full.empty:
             st.warning("Sua seleção está vazia. Volte à Etapa 1.")
         else:
-            st.caption("Marque 'Fixar' para obrigar a presença dessa disciplina nos cenários/grupos da Etapa 3.")
-            for _, row in selecionadas_full.iterrows():
-                rid = str(row["ROW_ID"])
-                label = f"Fixar | {row.get('CODIGO','')} — {row.get('DISCIPLINA','')} — Turma {row.get('TURMA','')}"
-                atual = rid in st.session_state["fixos_ids"]
-                novo_valor = st.checkbox(label, value=atual, key=f"fix_{rid}")
-                if novo_valor:
-                    st.session_state["fixos_ids"].add(rid)
-                else:
-                    st.session_state["fixos_ids"].discard(rid)
+            st.caption("Marque 'Fixar' para obrigar a presença dessa disciplina nos cenários/grupos da Etapa 3 e clique em 'Aplicar fixação'.")
+
+            # Tabela única de fixação (mesmo padrão de formulário da Etapa 1)
+            colunas_fix = [c for c in ['CODIGO', 'DISCIPLINA', 'TURMA', 'ROW_ID'] if c in selecionadas_full.columns]
+            df_fix_view = selecionadas_full[colunas_fix].copy()
+            df_fix_view.insert(0, "Fixar", df_fix_view["ROW_ID"].isin(st.session_state["fixos_ids"]))
+            df_fix_view = df_fix_view.set_index("ROW_ID", drop=False)
+
+            column_config_fix = {
+                "Fixar": st.column_config.CheckboxColumn(
+                    "Fixar",
+                    help="Marque para tornar esta disciplina obrigatória na Etapa 3",
+                    default=False
+                )
+            }
+            for c in colunas_fix:
+                column_config_fix[c] = st.column_config.Column(c, disabled=True)
+            column_config_fix["ROW_ID"] = None  # chave interna, oculta como na Etapa 1
+
+            with st.form("form_editor_fixar", clear_on_submit=False):
+                df_fix_editado = st.data_editor(
+                    df_fix_view,
+                    hide_index=True,
+                    use_container_width=True,
+                    key="editor_fixar",
+                    column_config=column_config_fix,
+                    num_rows="fixed"
+                )
+                submitted_fix = st.form_submit_button("Aplicar fixação")
+
+            # Atualiza os fixos somente no submit
+            if submitted_fix and not df_fix_editado.empty:
+                ids_visiveis = set(df_fix_editado["ROW_ID"].astype('int64').tolist())
+                ids_marcados = set(df_fix_editado.loc[df_fix_editado["Fixar"], "ROW_ID"].astype('int64').tolist())
+                st.session_state["fixos_ids"] -= ids_visiveis
+                st.session_state["fixos_ids"] |= ids_marcados
+                st.success("Fixação aplicada.")
 
             # Relatório de conflitos movido para a Etapa 2 e incluindo TURMA
             if not selecionadas_full.empty:
@@ -592,25 +1249,29 @@ else:
 
         # UI de agrupamento das fixas
         st.subheader("Agrupamento das disciplinas fixas")
-        fixed_ids_set = set(map(str, st.session_state.get("fixos_ids", set())))
+        fixed_ids_set = st.session_state["fixos_ids"]
         _ensure_fixed_subset_of_selected()
 
-        base_df = selecionadas_full.copy()
-        base_df["ROW_ID"] = base_df["ROW_ID"].astype(str)
+        base_df = selecionadas_full
 
         if not fixed_ids_set:
             st.info("Você não fixou disciplinas na Etapa 2. Você pode gerar combinações livremente.")
             df_fixas = pd.DataFrame(columns=base_df.columns)
         else:
-            df_fixas = base_df[base_df["ROW_ID"].isin(fixed_ids_set)].copy()
+            df_fixas = base_df[base_df["ROW_ID"].isin(fixed_ids_set)]
 
         grupos_rotulos = ["Sem grupo", "Grupo A", "Grupo B", "Grupo C"]
         st.caption("Atribua cada fixa a um grupo. Você pode usar dois grupos para rodadas separadas (OR) ou marcar 'juntos' para exigir todos (AND).")
 
         # Controles por fixa
-        for _, row in df_fixas.iterrows():
-            rid = str(row["ROW_ID"])
-            label = f"{row.get('CODIGO','')} — {row.get('DISCIPLINA','')} — Turma {row.get('TURMA','')}"
+        for rid, codigo, disciplina, turma in zip(
+            df_fixas["ROW_ID"].tolist(),
+            _valores_coluna(df_fixas, 'CODIGO'),
+            _valores_coluna(df_fixas, 'DISCIPLINA'),
+            _valores_coluna(df_fixas, 'TURMA'),
+        ):
+            rid = int(rid)
+            label = f"{codigo} — {disciplina} — Turma {turma}"
             default_group = st.session_state["mapa_grupos_fixas"].get(rid, "Sem grupo")
             st.session_state["mapa_grupos_fixas"][rid] = st.selectbox(
                 f"Grupo de: {label}",
@@ -669,103 +1330,120 @@ else:
             else:
                 cenarios = [set()]
 
-            # Funções auxiliares para validação
-            def _combo_ok(df_combo: pd.DataFrame) -> bool:
-                # 1) Conflitos
-                tem_conf, _ = check_conflito(df_combo)
-                if tem_conf:
-                    return False
-                # 2) Dias totais (se exigido)
-                if alvo_qtd_dias in {2, 3, 4} and dias_totais_da_grade(df_combo) != alvo_qtd_dias:
-                    return False
-                # 3) Regra de turnos consecutivos
-                tset = turnos_da_grade(df_combo)
-                if not is_turno_set_permitido(tset):
-                    return False
-                return True
+            # Colunas das grades exibidas (dias e score já vêm calculados de avaliar_combinacoes)
+            colunas_grade = [c for c in ['CODIGO', 'DISCIPLINA', 'CURSO', 'TURMA', 'Dia 1', 'Dia 2'] if c in base_df.columns]
 
             # Mapeia ROW_ID -> índice de base_df
             id_to_idx = {rid: idx for idx, rid in zip(base_df.index, base_df["ROW_ID"])}
 
             total_validas_global = 0
-            from itertools import combinations as _comb
+
+            # Combinações geradas por cenário, reaproveitadas enquanto seleção, obrigatórias,
+            # tamanhos e alvo de dias não mudarem (ex.: mudar só os turnos de preferência)
+            geradas_cache = st.session_state.get("_combinacoes_cached", {})
+            geradas_novas = {}
+            # Idem para o resultado já ordenado, que depende também dos turnos de preferência
+            ordenadas_cache = st.session_state.get("_ordenadas_cached", {})
+            ordenadas_novas = {}
 
             for idx_cen, obrig_rids in enumerate(cenarios, start=1):
                 st.subheader(f"Cenário {idx_cen}")
                 if obrig_rids:
+                    df_obrig = base_df[base_df["ROW_ID"].isin(obrig_rids)]
                     st.caption("Obrigatórias neste cenário: " + ", ".join(
-                        base_df[base_df["ROW_ID"].isin(obrig_rids)].apply(lambda r: f"{r['DISCIPLINA']} (Turma {r['TURMA']})", axis=1).tolist()
+                        f"{disciplina} (Turma {turma})"
+                        for disciplina, turma in zip(df_obrig['DISCIPLINA'].tolist(), df_obrig['TURMA'].tolist())
                     ))
                 else:
                     st.caption("Sem disciplinas obrigatórias neste cenário.")
 
                 obrig_idx = {id_to_idx[r] for r in obrig_rids if r in id_to_idx}
                 indices = list(base_df.index)
-                resto = [i for i in indices if i not in obrig_idx]
 
                 # Se o usuário escolheu um alvo > 0, respeitar exatamente o tamanho
                 if alvo_num_disciplinas > 0 and len(obrig_idx) > alvo_num_disciplinas:
                     st.warning(f"Alvo de {alvo_num_disciplinas} é menor que as obrigatórias deste cenário ({len(obrig_idx)}). Nenhuma combinação gerada para este cenário.")
                     continue
 
-                todas_validas = []
-                combinacoes_geradas = 0
-
                 # Tamanhos a considerar
                 if alvo_num_disciplinas == 0:
                     tamanhos = range(max(1, len(obrig_idx)), len(indices) + 1)
                 else:
                     tamanhos = [alvo_num_disciplinas]
 
-                for k in tamanhos:
-                    if k < len(obrig_idx):
-                        continue
-                    if len(obrig_idx) == k:
-                        # Combo é exatamente as obrigatórias
-                        combo_idx = list(sorted(obrig_idx))
-                        df_combo = base_df.loc[combo_idx].copy()
-                        if _combo_ok(df_combo):
-                            todas_validas.append(df_combo)
-                        combinacoes_geradas += 1
-                        if combinacoes_geradas >= MAX_COMBINACOES:
-                            break
-                    else:
-                        for extra in _comb(resto, k - len(obrig_idx)):
-                            combo_idx = list(sorted(obrig_idx)) + list(extra)
-                            df_combo = base_df.loc[combo_idx].copy()
-                            if _combo_ok(df_combo):
-                                todas_validas.append(df_combo)
-                            combinacoes_geradas += 1
-                            if combinacoes_geradas >= MAX_COMBINACOES:
-                                break
-                    if combinacoes_geradas >= MAX_COMBINACOES:
-                        break
-
-                # Ordena e exibe
-                todas_validas_sorted = sorted(
-                    todas_validas,
-                    key=lambda dfc: score_combo(
-                        dfc,
+                # Busca com poda (conflitos, dias e turnos); o score de todas é calculado em lote
+                chave_cenario = (
+                    versao_dados,
+                    frozenset(selected_ids),
+                    frozenset(obrig_idx),
+                    tuple(tamanhos),
+                    alvo_qtd_dias,
+                )
+                geradas = geradas_cache.get(chave_cenario)
+                if geradas is None:
+                    with st.spinner(f"Gerando combinações do cenário {idx_cen}..."):
+                        geradas = gerar_combinacoes(base_df, obrig_idx, tamanhos, alvo_qtd_dias)
+                geradas_novas[chave_cenario] = geradas
+                combinacoes, completa = geradas
+
+                chave_ordenadas = (chave_cenario, frozenset(turnos_pref))
+                ordenadas_cen = ordenadas_cache.get(chave_ordenadas)
+                if ordenadas_cen is None:
+                    if not completa:
+                        # A busca parou no limite: garante que as melhores pelo score estejam entre as sugestões
+                        with st.spinner(f"Buscando as melhores sugestões do cenário {idx_cen}..."):
+                            melhores = melhores_combinacoes(base_df, obrig_idx, tamanhos, alvo_qtd_dias, turnos_pref)
+                        existentes = set(map(tuple, combinacoes))
+                        combinacoes = combinacoes + [c for c in melhores if tuple(c) not in existentes]
+                    dias_combos, scores = avaliar_combinacoes(
+                        base_df,
+                        combinacoes,
                         turnos_pref,
                         alvo_qtd_dias if alvo_qtd_dias != "Qualquer" else None
-                    ),
-                    reverse=True
-                )
-
-                total_validas_global += len(todas_validas_sorted)
+                    )
+
+                    # Ordena (score decrescente, empates na ordem de geração) e só então monta os DataFrames:
+                    # uma única seleção posicional com as colunas usadas na exibição, fatiada por combinação.
+                    # Os scores são inteiros pequenos: em int16 a ordenação estável do NumPy é um radix sort (linear)
+                    chave_ordem = -scores
+                    if len(chave_ordem) and chave_ordem.min() >= np.iinfo(np.int16).min:
+                        chave_ordem = chave_ordem.astype(np.int16)
+                    ordem = np.argsort(chave_ordem, kind="stable")
+                    ordenadas = [combinacoes[i] for i in ordem]
+                    posicoes = base_df.index.get_indexer([r for combo in ordenadas for r in combo])
+                    limites = np.cumsum([0] + [len(combo) for combo in ordenadas])
+                    # Índice = ROW_ID (oculto na tabela; marca as linhas fixas em `_style_bold_fixed`)
+                    grades = base_df[colunas_grade].take(posicoes).set_axis(base_df["ROW_ID"].to_numpy()[posicoes])
+                    ordenadas_cen = (grades, limites, dias_combos[ordem], scores[ordem])
+                ordenadas_novas[chave_ordenadas] = ordenadas_cen
+
+                # Cada item é (grade, dias totais, score), para não recalcular na exibição;
+                # só as MAX_OPCOES_EXIBIDAS primeiras são montadas e listadas
+                grades, limites, dias_ord, scores_ord = ordenadas_cen
+                total_cen = len(limites) - 1
+                exibidas = min(total_cen, MAX_OPCOES_EXIBIDAS)
+                todas_validas_sorted = [
+                    (grades.iloc[ini:fim], dias, score)
+                    for ini, fim, dias, score in zip(
+                        limites[:exibidas], limites[1:exibidas + 1],
+                        dias_ord[:exibidas].tolist(), scores_ord[:exibidas].tolist(),
+                    )
+                ]
+
+                total_validas_global += total_cen
 
                 if not todas_validas_sorted:
                     st.info("Nenhuma combinação válida encontrada neste cenário.")
                 else:
-                    st.success(f"Combinações válidas no cenário {idx_cen}: {len(todas_validas_sorted)} (limite: {MAX_COMBINACOES:,}).")
+                    st.success(f"Combinações válidas no cenário {idx_cen}: {total_cen} (limite: {MAX_COMBINACOES:,}).")
 
                     # Top 4 sugestões do cenário
                     sugestoes = todas_validas_sorted[:4]
                     if sugestoes:
-                        for i, sug in enumerate(sugestoes, start=1):
+                        for i, (sug, dias_sug, score_sug) in enumerate(sugestoes, start=1):
                             st.subheader(f"Sugestão #{i} (Cenário {idx_cen})")
-                            view_cols = [c for c in ['CODIGO', 'DISCIPLINA', 'CURSO', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID'] if c in sug.columns]
-                            st.caption(f"Dias totais: {dias_totais_da_grade(sug)} • Score: {score_combo(sug, turnos_pref, alvo_qtd_dias if alvo_qtd_dias != 'Qualquer' else None)}")
+                            view_cols = [c for c in ['CODIGO', 'DISCIPLINA', 'CURSO', 'TURMA', 'Dia 1', 'Dia 2'] if c in sug.columns]
+                            st.caption(f"Dias totais: {dias_sug} • Score: {score_sug}")
                             styled = _style_bold_fixed(sug[view_cols], fixed_ids_set)
                             try:
                                 st.dataframe(styled, use_container_width=True, hide_index=True)
@@ -775,15 +1453,20 @@ else:
 
                     # Lista completa do cenário
                     st.markdown("Todas as opções válidas deste cenário (ordenadas por score)")
-                    for i, opt in enumerate(todas_validas_sorted, start=1):
-                        with st.expander(f"Opção #{i} • Dias: {dias_totais_da_grade(opt)} • Score: {score_combo(opt, turnos_pref, alvo_qtd_dias if alvo_qtd_dias != 'Qualquer' else None)}"):
-                            view_cols = [c for c in ['CODIGO', 'DISCIPLINA', 'CURSO', 'TURMA', 'Dia 1', 'Dia 2', 'ROW_ID'] if c in opt.columns]
+                    if total_cen > exibidas:
+                        st.caption(f"Lista truncada: exibindo as {exibidas:,} opções de maior score de {total_cen:,}.")
+                    for i, (opt, dias_opt, score_opt) in enumerate(todas_validas_sorted, start=1):
+                        with st.expander(f"Opção #{i} • Dias: {dias_opt} • Score: {score_opt}"):
+                            view_cols = [c for c in ['CODIGO', 'DISCIPLINA', 'CURSO', 'TURMA', 'Dia 1', 'Dia 2'] if c in opt.columns]
                             styled = _style_bold_fixed(opt[view_cols], fixed_ids_set)
                             try:
                                 st.dataframe(styled, use_container_width=True, hide_index=True)
                             except Exception:
                                 st.dataframe(opt[view_cols], use_container_width=True, hide_index=True)
 
+            st.session_state["_combinacoes_cached"] = geradas_novas
+            st.session_state["_ordenadas_cached"] = ordenadas_novas
+
             if fixed_ids_set:
                 st.caption(f"Destaque: linhas em negrito são disciplinas fixadas na Etapa 2.")
 
@@ -794,7 +1477,8 @@ else:
                     _go_to_step(2)
             with foot2:
                 if st.button("Reiniciar fluxo (limpar seleção/fixos)"):
-                    st.session_state["selecionados_ids"] = []
+                    st.session_state["selecionados_ids"] = set()
+                    _marcar_selecao_alterada()
                     st.session_state["fixos_ids"] = set()
                     st.session_state["confirmado"] = False
                     st.session_state["mapa_grupos_fixas"] = {}